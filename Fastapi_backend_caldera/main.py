@@ -10,16 +10,25 @@ ARQUITECTURA NUEVA (PRODUCCIÓN):
 Compatible con:
 - ESP32 con enableHeartbeat (Cliente PING -> Servidor PONG) (y viceversa)
 - Logs optimizados para Render.
+
+Despliegue:
+- Ejecutar con UN solo worker (uvicorn o gunicorn -w 1). global_state, esp32_clients
+  y front_clients viven en la memoria del proceso: con varios workers el relé, la
+  sonda y los frontends pueden caer en procesos distintos y los comandos no llegan.
 """
 
 from __future__ import annotations
 import asyncio
+import logging
+import logging.handlers
+import os
+import queue
+import sys
 import time
-import json 
-from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Union
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+import orjson
 import uvicorn
 
 # --------------------------------------------------------------------------
@@ -47,49 +56,179 @@ global_state = {
 
 # Estructura de conexiones: { "esp32_02":WebSocket, "esp32_03":WebSocket }
 esp32_clients: Dict[str, WebSocket] = {}
-# Frontends: Lista de WebSockets
-front_clients: list[WebSocket] = []
+# Frontends: Conjunto de WebSockets (alta/baja/pertenencia en O(1))
+front_clients: set[WebSocket] = set()
+# Subconjunto de frontends que pidieron tramas de texto ("prefers_text" al registrarse)
+text_front_clients: set[WebSocket] = set()
+
+# Esqueleto del full_state_update (system_state es referencia a global_state)
+BROADCAST_PAYLOAD: Dict[str, Any] = {
+    "type": "full_state_update",
+    "connection_status": {"esp32_02": "disconnected", "esp32_03": "disconnected"},
+    "system_state": global_state,
+    "timestamp": "",
+}
+
+# Mensajes de heartbeat ya serializados (sin dict ni json por envío)
+PING_JSON = '{"type":"ping"}'
+PONG_JSON = '{"type":"pong"}'
+
+# Señal de "estado sucio": la consume broadcaster_task para agrupar ráfagas
+broadcast_pending = asyncio.Event()
+BROADCAST_DEBOUNCE_S = 0.05
+# Firma del último estado enviado a frontends (None = forzar el próximo envío)
+last_broadcast_sig: Optional[tuple] = None
+# Si solo cambia la temperatura se envía un delta; el estado completo se
+# reenvía como reconciliación cada FULL_SYNC_INTERVAL_S (y al registrarse un frontend)
+FULL_SYNC_INTERVAL_S = 30
+last_full_sync = 0.0
 
 # --------------------------------------------------------------------------
 # 📝 LOGGING UNIFICADO
 # --------------------------------------------------------------------------
+# Cache (segundo, texto): ts() solo formatea una vez por segundo
+_ts_cache = (0, "")
+
 def ts() -> str:
-    return datetime.now().strftime("%H:%M:%S")
+    global _ts_cache
+    now = int(time.time())
+    if now != _ts_cache[0]:
+        _ts_cache = (now, time.strftime("%H:%M:%S", time.localtime(now)))
+    return _ts_cache[1]
+
+# La escritura a stdout la hace un hilo aparte (QueueListener): el bucle de
+# eventos solo encola el registro y nunca se bloquea en un print()
+logger = logging.getLogger("caldera")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(logging.Formatter("%(message)s"))
+log_listener = logging.handlers.QueueListener(_log_queue, _stdout_handler)
 
 def log_event(origen: str, accion: str, mensaje: str = ""):
-    print(f"{ts()} [{origen}] {accion} | {mensaje}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s [%s] %s | %s", ts(), origen, accion, mensaje)
 
 # --------------------------------------------------------------------------
 # 📡 UTILIDADES DE ENVÍO
 # --------------------------------------------------------------------------
+def dumps_text(payload: Dict[str, Any]) -> str:
+    """JSON compacto con orjson (Starlette send_json usa el módulo json)."""
+    return orjson.dumps(payload).decode()
+
+def frame_text(raw: Union[str, bytes]) -> str:
+    """Texto de una trama recibida: los ESP32 solo procesan tramas de texto."""
+    return raw if isinstance(raw, str) else raw.decode()
+
 async def safe_send_json(ws: WebSocket, payload: Dict[str, Any]) -> bool:
     try:
-        await ws.send_json(payload)
+        await ws.send_text(dumps_text(payload))
         return True
     except Exception:
         return False
 
+async def safe_send_text(ws: WebSocket, text: str) -> bool:
+    try:
+        await ws.send_text(text)
+        return True
+    except Exception:
+        return False
+
+def drop_front(ws: WebSocket) -> None:
+    front_clients.discard(ws)
+    text_front_clients.discard(ws)
+
+def scalar(value: Any, default: Any) -> Any:
+    """Solo se guardan valores simples en global_state (nada de listas/objetos anidados)."""
+    return value if value is None or isinstance(value, (str, int, float)) else default
+
+def set_connection_status(client_id: str, connected: bool) -> None:
+    """Refleja alta/baja de un ESP32 conocido en la plantilla del broadcast."""
+    cs = BROADCAST_PAYLOAD["connection_status"]
+    if client_id in cs:
+        cs[client_id] = "connected" if connected else "disconnected"
+
+def state_signature() -> tuple:
+    """Resumen barato del estado visible por los frontends (sin timestamp)."""
+    return (
+        global_state["mode"],
+        global_state["relay_state"],
+        global_state["current_temp"],
+        global_state["target_temp"],
+        "esp32_02" in esp32_clients,
+        "esp32_03" in esp32_clients,
+    )
+
+def request_broadcast(force: bool = False) -> None:
+    """Marca el estado como sucio; force=True lo envía aunque no haya cambiado."""
+    global last_broadcast_sig
+    if force:
+        last_broadcast_sig = None
+    if not front_clients:
+        # Nadie escuchando: ni siquiera se despierta a broadcaster_task
+        return
+    broadcast_pending.set()
+
 async def broadcast_state() -> None:
-    """Envía el estado completo a todos los frontends."""
-    payload = {
-        "type": "full_state_update",
-        "connection_status": {
-            "esp32_02": "connected" if "esp32_02" in esp32_clients else "disconnected",
-            "esp32_03": "connected" if "esp32_03" in esp32_clients else "disconnected"
-        },
-        "system_state": global_state,
-        "timestamp": ts()
-    }
-    
-    # Broadcast a frontends
-    to_remove = []
-    for ws in front_clients:
-        if not await safe_send_json(ws, payload):
-            to_remove.append(ws)
+    """Envía el estado a todos los frontends (si ha cambiado): delta o completo."""
+    global last_broadcast_sig, last_full_sync
+    if not front_clients:
+        return
+    sig = state_signature()
+    if sig == last_broadcast_sig:
+        return
+    prev = last_broadcast_sig
+    last_broadcast_sig = sig
+
+    now = time.monotonic()
+    # sig[2] es current_temp: ¿es lo único que ha cambiado?
+    only_temp = (
+        prev is not None
+        and sig[:2] == prev[:2]
+        and sig[3:] == prev[3:]
+        and now - last_full_sync < FULL_SYNC_INTERVAL_S
+    )
+    # Serializar una sola vez: orjson ya da UTF-8 válido, se envía como trama binaria
+    if only_temp:
+        # Mismo formato que sensor_update, que el frontend ya sabe aplicar
+        raw = orjson.dumps({"type": "sensor_update", "temperature": global_state["current_temp"]})
+    else:
+        last_full_sync = now
+        # Plantilla reutilizada: connection_status ya se actualiza al (des)conectar,
+        # aquí solo cambia el timestamp; se serializa antes de cualquier await
+        BROADCAST_PAYLOAD["timestamp"] = ts()
+        raw = orjson.dumps(BROADCAST_PAYLOAD)
+    text = raw.decode() if text_front_clients else ""
     
-    for ws in to_remove:
-        if ws in front_clients:
-            front_clients.remove(ws)
+    # Broadcast concurrente a frontends (copia: el conjunto puede cambiar durante
+    # el await). Los errores los recoge gather, sin try/except por envío.
+    fronts = tuple(front_clients)
+    results = await asyncio.gather(
+        *(ws.send_text(text) if ws in text_front_clients else ws.send_bytes(raw) for ws in fronts),
+        return_exceptions=True,
+    )
+    for ws, result in zip(fronts, results):
+        if isinstance(result, BaseException):
+            drop_front(ws)
+
+async def broadcaster_task():
+    """
+    Tarea de fondo que agrupa los cambios de estado.
+    - Tras cada aviso espera BROADCAST_DEBOUNCE_S y envía una sola vez el estado
+      más reciente (full_state_update, o sensor_update si solo cambió la temperatura).
+    - Un fallo en un envío se registra y no detiene la tarea.
+    """
+    while True:
+        await broadcast_pending.wait()
+        await asyncio.sleep(BROADCAST_DEBOUNCE_S)
+        # Limpiar tras la espera: los avisos llegados durante ella ya van incluidos
+        broadcast_pending.clear()
+        try:
+            await broadcast_state()
+        except Exception as e:
+            log_event("ERROR", "Fallo en broadcast", str(e))
 
 # --------------------------------------------------------------------------
 # ❤️ KEEP-ALIVE & LIMPIEZA DE ZOMBIS
@@ -97,36 +236,34 @@ async def broadcast_state() -> None:
 async def keep_alive_task():
     """
     Tarea de fondo para pings periódicos y limpieza.
-    - Los ESP32 ahora tienen heartbeat propio, pero el servidor también verifica.
+    - El latido real va por tramas PING/PONG del protocolo WS (ws_ping_interval),
+      que gestiona la librería websockets sin despertar al handler.
+    - El ping de aplicación queda solo para los ESP32, como respaldo compatible
+      con su firmware, que responde {"type":"pong"}.
     """
     while True:
         await asyncio.sleep(15) # Check cada 15s (menos agresivo que antes)
         
-        # 1. Ping a ESP32s
-        dead_esps = []
-        for pid, ws in list(esp32_clients.items()):
-            if not await safe_send_json(ws, {"type": "ping"}):
-                dead_esps.append(pid)
+        # 1. Ping concurrente a ESP32s (un cliente lento no retrasa al resto)
+        # Instantánea (tuple, más barata que list): se empareja con los
+        # resultados tras el await, cuando el registro ya puede haber cambiado
+        esp_items = tuple(esp32_clients.items())
+        results = await asyncio.gather(
+            *(safe_send_text(ws, PING_JSON) for _, ws in esp_items),
+            return_exceptions=True,
+        )
+        dead_esps = [pid for (pid, _), ok in zip(esp_items, results) if ok is not True]
         
         # 2. Limpieza y Fail-Safe
         for pid in dead_esps:
             log_event("SISTEMA", "Limpieza Zombie", f"Eliminando {pid} por timeout")
             await handle_disconnect(pid)
 
-        # 3. Ping a Frontends
-        dead_fronts = []
-        for ws in front_clients:
-            if not await safe_send_json(ws, {"type": "ping"}):
-                dead_fronts.append(ws)
-        
-        for ws in dead_fronts:
-            if ws in front_clients:
-                front_clients.remove(ws)
-
 async def handle_disconnect(client_id: str):
     """Maneja la desconexión de un ESP32 con lógica de seguridad."""
     if client_id in esp32_clients:
         del esp32_clients[client_id]
+    set_connection_status(client_id, False)
     
     msg_extra = ""
     # --- LÓGICA FAIL-SAFE ---
@@ -149,13 +286,31 @@ async def handle_disconnect(client_id: str):
                 pass
 
     log_event("CONEXIÓN", "Desconexión detectada", f"{client_id} {msg_extra}")
-    await broadcast_state()
+    request_broadcast()
+
+# asyncio solo guarda referencias débiles a las tareas: se retienen aquí
+background_tasks: set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    """Lanza una tarea de fondo manteniendo la referencia hasta que termine."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(keep_alive_task())
+    log_listener.start()
+    spawn(keep_alive_task())
+    spawn(broadcaster_task())
     log_event("SISTEMA", "Inicio Servidor", "Modo Centralizado Listo (Render Optimized)")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    log_event("SISTEMA", "Parada Servidor")
+    # Vacía la cola pendiente antes de salir
+    log_listener.stop()
+
 # --------------------------------------------------------------------------
 # 🔌 WEBSOCKET ENDPOINT
 # --------------------------------------------------------------------------
@@ -169,8 +324,20 @@ async def websocket_endpoint(ws: WebSocket):
     
     try:
         while True:
-            # Esperar JSON
-            data = await ws.receive_json()
+            # Esperar JSON (parseo con orjson; se ignoran tramas no válidas).
+            # Trama de texto o binaria: orjson parsea bytes sin pasar por str
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            raw = message.get("bytes") or message.get("text") or ""
+            try:
+                data = orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                log_event("ERROR", "JSON inválido", f"IP: {client_ip}")
+                continue
+            if not isinstance(data, dict):
+                # JSON válido pero no es un objeto (lista, número...): ignorar
+                continue
             msg_type = data.get("type", "")
 
             # --- FASE 1: REGISTRO/IDENTIFICACIÓN ---
@@ -182,23 +349,25 @@ async def websocket_endpoint(ws: WebSocket):
                     
                     if role == "esp32" and client_id:
                         esp32_clients[client_id] = ws
+                        set_connection_status(client_id, True)
                         log_event("CONEXIÓN", "ESP32 Registrado", f"ID: {client_id} | IP: {client_ip}")
-                        await ws.send_json({"type": "registered", "id": client_id})
-                        await broadcast_state()
+                        await ws.send_text(dumps_text({"type": "registered", "id": client_id}))
+                        request_broadcast()
                     else:
                         # Frontend suele mandar register o simplemente conectar
                         # Si no es esp32, asumimos frontend si type="register" o connect
                         role = "frontend"
-                        if ws not in front_clients:
-                            front_clients.append(ws)
+                        front_clients.add(ws)
+                        if data.get("prefers_text"):
+                            text_front_clients.add(ws)
                         log_event("CONEXIÓN", "Frontend Registrado", f"IP: {client_ip}")
-                        await ws.send_json({"type": "registered"})
-                        await broadcast_state()
+                        await ws.send_text(dumps_text({"type": "registered"}))
+                        # El nuevo frontend necesita el estado aunque no haya cambiado
+                        request_broadcast(force=True)
                 else:
                      # Si manda algo distinto a register de entrada, asumimos frontend o error
                      role = "frontend" # Fallback permissive
-                     if ws not in front_clients:
-                        front_clients.append(ws)
+                     front_clients.add(ws)
                      log_event("CONEXIÓN", "Frontend Auto-Detectado", f"IP: {client_ip} (msg: {msg_type})")
 
                 # Continuar al siguiente loop ya identificado
@@ -206,9 +375,10 @@ async def websocket_endpoint(ws: WebSocket):
 
             # --- FASE 2: OPERACIÓN NORMAL ---
             
-            # > PING/PONG (Heartbeat de librería Client o Server)
+            # > PING/PONG de aplicación (compatibilidad con clientes antiguos;
+            #   el heartbeat normal va por tramas de control del protocolo)
             if msg_type == "ping":
-                await ws.send_json({"type": "pong"})
+                await ws.send_text(PONG_JSON)
                 continue
             if msg_type == "pong":
                 # Heartbeat ack, no action needed
@@ -217,31 +387,35 @@ async def websocket_endpoint(ws: WebSocket):
             # > MENSAJES DE ESP32
             if role == "esp32":
                 if msg_type == "sensor_update": # ESP32_03
-                    temp = data.get("temperature")
-                    global_state["current_temp"] = temp
-                    # Reenviar a relé si existe
+                    temp = scalar(data.get("temperature"), None)
+                    # Cuantizar a 0.1 °C: el ruido del ADC no genera broadcasts
+                    if isinstance(temp, (int, float)):
+                        temp = round(temp, 1)
+                    # Reenviar a relé si existe (trama cruda, sin re-serializar)
                     if "esp32_02" in esp32_clients:
-                        await safe_send_json(esp32_clients["esp32_02"], data)
-                    await broadcast_state()
+                        await safe_send_text(esp32_clients["esp32_02"], frame_text(raw))
+                    if temp != global_state["current_temp"]:
+                        global_state["current_temp"] = temp
+                        request_broadcast()
                 
                 elif msg_type == "status_update": # ESP32_02
-                    global_state["mode"] = data.get("mode", global_state["mode"])
-                    new_relay = data.get("relay_state", "OFF")
+                    global_state["mode"] = scalar(data.get("mode", global_state["mode"]), global_state["mode"])
+                    new_relay = scalar(data.get("relay_state", "OFF"), "OFF")
                     
                     if global_state["relay_state"] != new_relay:
                         log_event("SISTEMA", "Cambio Estado Relé", f"{new_relay} (Modo: {global_state['mode']})")
                     
                     global_state["relay_state"] = new_relay
-                    global_state["target_temp"] = data.get("target_temp", global_state["target_temp"])
-                    await broadcast_state()
+                    global_state["target_temp"] = scalar(data.get("target_temp", global_state["target_temp"]), global_state["target_temp"])
+                    request_broadcast()
 
             # > MENSAJES DE FRONTEND
             elif role == "frontend":
                 if msg_type == "config_update":
                     log_event("COMANDO", "Config Update", f"Modo={data.get('mode')}, T={data.get('target_temp')}")
-                    # Reenviar a ESP32_02
+                    # Reenviar a ESP32_02 (trama cruda, sin re-serializar)
                     if "esp32_02" in esp32_clients:
-                        await safe_send_json(esp32_clients["esp32_02"], data)
+                        await safe_send_text(esp32_clients["esp32_02"], frame_text(raw))
                     else:
                          log_event("ERROR", "No se pudo enviar comando", "ESP32_02 desconectado")
 
@@ -250,8 +424,7 @@ async def websocket_endpoint(ws: WebSocket):
         if role == "esp32" and client_id:
             await handle_disconnect(client_id)
         elif role == "frontend":
-             if ws in front_clients:
-                 front_clients.remove(ws)
+             drop_front(ws)
              log_event("CONEXIÓN", "Frontend Desconectado", client_ip)
     except Exception as e:
         log_event("ERROR", "Excepción WS", str(e))
@@ -260,4 +433,20 @@ async def websocket_endpoint(ws: WebSocket):
             await handle_disconnect(client_id)
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # uvloop no existe en Windows: allí se mantiene el loop asyncio estándar
+    loop_impl = "asyncio" if sys.platform == "win32" else "uvloop"
+    # Recarga automática solo en desarrollo (DEV=1): evita el proceso supervisor
+    # y el vigilante de ficheros en producción
+    dev_mode = bool(os.getenv("DEV"))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=dev_mode,
+        loop=loop_impl,
+        http="httptools",
+        ws="websockets",
+        # Heartbeat a nivel de protocolo (tramas PING/PONG de RFC 6455)
+        ws_ping_interval=15,
+        ws_ping_timeout=10,
+    )
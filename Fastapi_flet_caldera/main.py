@@ -7,70 +7,145 @@
 from __future__ import annotations
 
 import asyncio
+import atexit
 import json
+import logging
+import logging.handlers
 import os
+import queue
+import random
+import sys
+from functools import lru_cache, partial
 from typing import Callable, Optional
 
 import flet as ft
 import websockets
-from dotenv import load_dotenv
+
+# python-dotenv es opcional: sin él (p.ej. en PyPy mínimo) se usa solo el entorno
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    load_dotenv = None
+
+# orjson (C) si está instalado; si no (p.ej. PyPy), el módulo json estándar.
+# orjson.JSONDecodeError hereda de json.JSONDecodeError: un único except vale para ambos.
+# Con orjson json_dumps devuelve bytes: websockets los envía como trama binaria
+# sin recodificar (el backend acepta texto o binario).
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
 
 # ===============================================================================
 # 🌐 CONFIGURACIÓN
 # ===============================================================================
-load_dotenv()
+if load_dotenv is not None:
+    load_dotenv()
 PORT = int(os.environ.get("PORT", 0))
 WEBSOCKET_URL = os.getenv("WEBSOCKET_URL")
 
 if not WEBSOCKET_URL:
     raise ValueError("⚠️ ERROR: La variable WEBSOCKET_URL no está definida en .env")
 
+# ===============================================================================
+# 📝 LOGGING
+# ===============================================================================
+# El bucle de eventos solo encola; la escritura a la consola la hace un hilo aparte
+log = logging.getLogger("caldera")
+log.setLevel(logging.INFO)
+log.propagate = False
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# ===============================================================================
+# 🧰 UTILIDADES
+# ===============================================================================
+# Dict vacío compartido para claves ausentes (solo lectura por convención)
+_EMPTY: dict = {}
+# Centinela "aún no pintado" (distinto de None, que significa "sin lectura")
+_UNSET = object()
+
+@lru_cache(maxsize=1024)
+def fmt_celsius(tenths: int) -> str:
+    """Texto '21.5°C' para una temperatura en décimas de grado (memoizado)."""
+    return f"{tenths / 10:.1f}°C"
+
 # ===============================================================================
 # 🧠 CLIENTE WEBSOCKET
 # ===============================================================================
 class WebSocketClient:
-    def __init__(self, ui_callback: Callable[[dict], None]):
+    """
+    Cliente WebSocket del frontend.
+    - Contrato: ui_callback solo recibe dict. El tipo se valida una única vez en
+      _connect_once (`type(data) is dict`); los manejadores de UI no lo repiten.
+    """
+    __slots__ = ("websocket", "ui_callback", "_stop", "_fail_count")
+
+    # Trama de registro estática: se serializa una sola vez
+    REGISTER_FRAME = json_dumps({"type": "register", "role": "frontend"})
+
+    def __init__(self, ui_callback: Callable[[dict], None]) -> None:
         self.websocket: Optional[websockets.WebSocketClientProtocol] = None
         self.ui_callback = ui_callback
         self._stop = False
+        self._fail_count = 0  # Reintentos seguidos sin llegar a registrarse
 
-    async def connect_forever(self):
+    def _reconnect_delay(self) -> float:
+        """Backoff exponencial 1s→2s→…→30s con ±20% de jitter."""
+        delay = min(30, 2 ** min(self._fail_count, 5))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def connect_forever(self) -> None:
         while not self._stop:
             try:
                 await self._connect_once()
             except Exception as e:
-                print(f"❌ Error WS: {e}")
+                log.error("❌ Error WS: %s", e)
             finally:
                 self.websocket = None
                 self.ui_callback({"type": "disconnected"}) # Aviso interno
-                await asyncio.sleep(5)
+                delay = self._reconnect_delay()
+                self._fail_count += 1
+                await asyncio.sleep(delay)
 
-    async def _connect_once(self):
-        print(f"🔌 Conectando a {WEBSOCKET_URL}...")
+    async def _connect_once(self) -> None:
+        log.info("🔌 Conectando a %s...", WEBSOCKET_URL)
         async with websockets.connect(WEBSOCKET_URL, ping_interval=None) as ws:
             self.websocket = ws
-            print("✅ Conectado")
+            log.info("✅ Conectado")
             
-            await self.send_json({"type": "register", "role": "frontend"})
+            await ws.send(self.REGISTER_FRAME)
             
             async for message in ws:
+                # Tramas de texto (str) o binarias (bytes): basura evidente fuera sin parsear
+                if message[:1] not in ("{", b"{"):
+                    continue
                 try:
-                    data = json.loads(message)
-                    if isinstance(data, dict):
-                        self.ui_callback(data)
+                    data = json_loads(message)
                 except json.JSONDecodeError:
-                    pass
+                    continue
+                if type(data) is dict:
+                    if data.get("type") == "registered":
+                        self._fail_count = 0
+                    self.ui_callback(data)
 
-    async def send_json(self, payload: dict):
+    async def send_json(self, payload: dict) -> None:
         if self.websocket:
             try:
-                await self.websocket.send(json.dumps(payload))
+                await self.websocket.send(json_dumps(payload))
             except Exception:
                 self.websocket = None
 
-    async def send_config_update(self, mode: str, target_temp: float):
+    async def send_config_update(self, mode: str, target_temp: float) -> None:
         """Envía la nueva configuración deseada por el usuario"""
-        print(f"📤 Enviando Config: {mode} | {target_temp}°C")
+        log.info("📤 Enviando Config: %s | %s°C", mode, target_temp)
         await self.send_json({
             "type": "config_update",
             "mode": mode,         # "AUTO" | "MANUAL"
@@ -91,6 +166,26 @@ def main(page: ft.Page):
     # --- Estado Local (Solo para UI, la verdad absoluta viene del Backend) ---
     current_mode = "MANUAL"
     current_target = 21.5
+    # Último valor pintado de cada bloque (evita reescribir widgets sin cambios)
+    last_conn: Optional[tuple] = None
+    last_current_temp: object = _UNSET
+    # Última trama de estado aplicada (se invalida con cambios locales del usuario)
+    last_state_key: Optional[tuple] = None
+
+    # --- Refresco agrupado: como mucho un page.update() por frame (~16 ms) ---
+    update_pending = False
+
+    async def flush_update():
+        nonlocal update_pending
+        await asyncio.sleep(0.016)
+        update_pending = False
+        page.update()
+
+    def schedule_update():
+        nonlocal update_pending
+        if not update_pending:
+            update_pending = True
+            page.run_task(flush_update)
     
     # --- Componentes UI ---
     
@@ -110,29 +205,47 @@ def main(page: ft.Page):
     lbl_current_desc = ft.Text("Temperatura Actual", size=16, color=ft.Colors.GREY)
 
     # 4. Control de Temperatura Objetivo
-    txt_target_temp = ft.Text(f"{current_target}°C", size=40, weight=ft.FontWeight.W_500, color=ft.Colors.CYAN)
+    txt_target_temp = ft.Text(fmt_celsius(round(current_target * 10)), size=40, weight=ft.FontWeight.W_500, color=ft.Colors.CYAN)
     
     # FIX: Async Helper para run_task
     async def send_config_helper():
         await ws_client.send_config_update(current_mode, current_target)
 
+    # Debounce de +/-: mantener pulsado solo envía el valor final (150 ms sin pulsar)
+    pending_config_send = None
+
+    async def send_config_debounced(target: float):
+        nonlocal pending_config_send
+        await asyncio.sleep(0.15)
+        pending_config_send = None  # A partir de aquí el envío ya no se cancela
+        # Se envía el objetivo elegido al pulsar, no el que haya en current_target
+        await ws_client.send_config_update(current_mode, target)
+
+    def schedule_config_send():
+        nonlocal pending_config_send
+        if pending_config_send is not None:
+            pending_config_send.cancel()
+        pending_config_send = page.run_task(send_config_debounced, current_target)
+
     def change_target(e, delta):
-        nonlocal current_target
+        nonlocal current_target, last_state_key
+        last_state_key = None
         current_target = round(current_target + delta, 1)
-        txt_target_temp.value = f"{current_target}°C"
-        # Enviar comando usando el helper async
-        page.run_task(send_config_helper)
-        page.update()
+        txt_target_temp.value = fmt_celsius(round(current_target * 10))
+        # Enviar comando (agrupando pulsaciones seguidas)
+        schedule_config_send()
+        schedule_update()
 
-    btn_minus = ft.IconButton(ft.Icons.REMOVE, on_click=lambda e: change_target(e, -0.5), icon_color=ft.Colors.CYAN, icon_size=40)
-    btn_plus = ft.IconButton(ft.Icons.ADD, on_click=lambda e: change_target(e, 0.5), icon_color=ft.Colors.CYAN, icon_size=40)
+    btn_minus = ft.IconButton(ft.Icons.REMOVE, on_click=partial(change_target, delta=-0.5), icon_color=ft.Colors.CYAN, icon_size=40)
+    btn_plus = ft.IconButton(ft.Icons.ADD, on_click=partial(change_target, delta=0.5), icon_color=ft.Colors.CYAN, icon_size=40)
 
     # 5. Modo de Operación
     def toggle_mode(e):
-        nonlocal current_mode
+        nonlocal current_mode, last_state_key
+        last_state_key = None
         current_mode = "AUTO" if e.control.value else "MANUAL"
         page.run_task(send_config_helper)
-        page.update()
+        schedule_update()
 
     sw_mode = ft.Switch(label="Modo Automático", value=False, on_change=toggle_mode, active_color=ft.Colors.GREEN)
     
@@ -146,57 +259,84 @@ def main(page: ft.Page):
     )
 
     # --- Lógica de Actualización UI ---
-    def update_ui(data):
-        nonlocal current_mode, current_target
-        t = data.get("type")
-
-        # A) Conexión / Desconexión Backend
-        if t == "registered":
-            status_icon.name = ft.Icons.WIFI
-            status_icon.color = ft.Colors.GREEN
-            status_text.value = "Conectado"
-            status_text.color = ft.Colors.GREEN
-            page.update()
-        
-        elif t == "disconnected":
-            status_icon.name = ft.Icons.WIFI_OFF
-            status_icon.color = ft.Colors.RED
-            status_text.value = "Desconectado"
-            status_text.color = ft.Colors.RED
-            
-            # Desactivar controles
-            sw_mode.disabled = True
-            btn_plus.disabled = True
-            btn_minus.disabled = True
-
-            # Estado visual seguro
-            card_status.bgcolor = ft.Colors.GREY
-            card_status.content.value = "SIN CONEXIÓN"
-            led_relay.color = ft.Colors.RED
-            led_sensor.color = ft.Colors.RED
-            page.update()
+    # Colores/iconos de los manejadores resueltos una vez (variable de cierre en
+    # lugar de dos búsquedas de atributo por uso en cada mensaje)
+    GREEN, RED, WHITE = ft.Colors.GREEN, ft.Colors.RED, ft.Colors.WHITE
+    GREY, GREY_900 = ft.Colors.GREY, ft.Colors.GREY_900
+    ORANGE, ORANGE_900, RED_900 = ft.Colors.ORANGE, ft.Colors.ORANGE_900, ft.Colors.RED_900
+    WIFI, WIFI_OFF = ft.Icons.WIFI, ft.Icons.WIFI_OFF
+    # Bordes de la tarjeta de estado creados una vez: se asignan por referencia
+    BORDER_RED = ft.border.all(2, RED)
+    BORDER_ORANGE = ft.border.all(2, ORANGE)
+
+    # Un manejador por tipo de mensaje, despachado desde update_ui con una tabla
+    def on_registered(data):
+        status_icon.name = WIFI
+        status_icon.color = GREEN
+        status_text.value = "Conectado"
+        status_text.color = GREEN
+        schedule_update()
+
+    def on_disconnected(data):
+        nonlocal last_conn, last_state_key
+        status_icon.name = WIFI_OFF
+        status_icon.color = RED
+        status_text.value = "Desconectado"
+        status_text.color = RED
+
+        # Desactivar controles
+        sw_mode.disabled = True
+        btn_plus.disabled = True
+        btn_minus.disabled = True
+
+        # Estado visual seguro
+        card_status.bgcolor = GREY
+        card_status.content.value = "SIN CONEXIÓN"
+        led_relay.color = RED
+        led_sensor.color = RED
+        # La tarjeta y los controles se han tocado: forzar repintado al reconectar
+        last_conn = None
+        last_state_key = None
+        schedule_update()
+
+    # B) Estado Completo (o parcial: status_update / sensor_update)
+    def on_state(data):
+        nonlocal current_mode, current_target, last_conn, last_current_temp, last_state_key
+        get = data.get
+        t = get("type")
+        conn = get("connection_status") or _EMPTY
+        sys_state = get("system_state") or _EMPTY
+
+        # Parches para actualizaciones parciales (copia: _EMPTY nunca se muta)
+        if not sys_state and (t == "status_update"): sys_state = data
+        if t == "sensor_update": sys_state = dict(sys_state, current_temp=get("temperature"))
+
+        mode = sys_state.get("mode")
+        relay_state = sys_state.get("relay_state")
+        curr = sys_state.get("current_temp")
+        tgt = sys_state.get("target_temp")
+
+        # Misma trama que la última aplicada: no hay nada que recalcular ni repintar
+        state_key = (t, conn.get("esp32_02"), conn.get("esp32_03"), mode, relay_state, curr, tgt)
+        if state_key == last_state_key:
             return
+        last_state_key = state_key
 
-        # B) Estado Completo
-        if t == "full_state_update" or t == "status_update" or t == "sensor_update":
-            conn = data.get("connection_status", {})
-            sys_state = data.get("system_state", {})
-            
-            # Parches para actualizaciones parciales
-            if not sys_state and (t == "status_update"): sys_state = data
-            if t == "sensor_update": sys_state["current_temp"] = data.get("temperature")
-            
-            # 1. Conectividad
-            # IMPORTANTE: Bloqueo de UI si falta el Relé
-            relay_connected = False
-            if conn:
-                relay_connected = (conn.get("esp32_02") == "connected")
-                sensor_connected = (conn.get("esp32_03") == "connected")
-                
-                led_relay.color = ft.Colors.GREEN if relay_connected else ft.Colors.RED
+        # 1. Conectividad
+        # IMPORTANTE: Bloqueo de UI si falta el Relé
+        relay_connected = False
+        if conn:
+            relay_connected = (conn.get("esp32_02") == "connected")
+            sensor_connected = (conn.get("esp32_03") == "connected")
+
+            # Solo tocar los widgets si la conectividad ha cambiado
+            if (relay_connected, sensor_connected) != last_conn:
+                last_conn = (relay_connected, sensor_connected)
+
+                led_relay.color = GREEN if relay_connected else RED
                 lbl_relay.value = "Relé: OK" if relay_connected else "Relé: OFF"
-                
-                led_sensor.color = ft.Colors.GREEN if sensor_connected else ft.Colors.RED
+
+                led_sensor.color = GREEN if sensor_connected else RED
                 lbl_sensor.value = "Sonda: OK" if sensor_connected else "Sonda: OFF"
 
                 # LÓGICA DE BLOQUEO UI
@@ -204,57 +344,73 @@ def main(page: ft.Page):
                 sw_mode.disabled = not controls_enabled
                 btn_plus.disabled = not controls_enabled
                 btn_minus.disabled = not controls_enabled
-                
+
                 if not relay_connected:
-                    card_status.bgcolor = ft.Colors.RED_900
+                    card_status.bgcolor = RED_900
                     card_status.content.value = "⚠️ RELÉ OFF"
-                    card_status.content.color = ft.Colors.WHITE
-                    card_status.border = ft.border.all(2, ft.Colors.RED)
-                
+                    card_status.content.color = WHITE
+                    card_status.border = BORDER_RED
+
                 elif not sensor_connected:
-                    card_status.bgcolor = ft.Colors.ORANGE_900
+                    card_status.bgcolor = ORANGE_900
                     card_status.content.value = "⚠️ SONDA OFF"
-                    card_status.content.color = ft.Colors.WHITE
-                    card_status.border = ft.border.all(2, ft.Colors.ORANGE)
-
-            # 2. Valores del Sistema (Solo actualizar si Relé está vivo, o solo info visual)
-            mode = sys_state.get("mode")
-            relay_on = sys_state.get("relay_state") == "ON"
-            curr = sys_state.get("current_temp")
-            tgt = sys_state.get("target_temp")
-
-            if mode and relay_connected: # Solo aceptamos "verdad" de modo si el relé está conectado
-                if mode != current_mode:
-                    current_mode = mode
-                    sw_mode.value = (mode == "AUTO")
-            
-            if tgt:
-                tgt_val = float(tgt)
-                if abs(tgt_val - current_target) > 0.1:
-                    current_target = tgt_val
-                    txt_target_temp.value = f"{current_target}°C"
-
-            if curr is not None:
-                txt_current_temp.value = f"{float(curr):.1f}°C"
-                txt_current_temp.color = ft.Colors.WHITE
+                    card_status.content.color = WHITE
+                    card_status.border = BORDER_ORANGE
+
+        # 2. Valores del Sistema (Solo actualizar si Relé está vivo, o solo info visual)
+        relay_on = relay_state == "ON"
+
+        if mode and relay_connected: # Solo aceptamos "verdad" de modo si el relé está conectado
+            if mode != current_mode:
+                current_mode = mode
+                sw_mode.value = (mode == "AUTO")
+
+        # Con un envío pendiente manda la pulsación local, no el objetivo (anterior) del backend
+        if tgt and pending_config_send is None:
+            tgt_val = float(tgt)
+            if abs(tgt_val - current_target) > 0.1:
+                current_target = tgt_val
+                txt_target_temp.value = fmt_celsius(round(current_target * 10))
+
+        # Sin cambio respecto al último valor mostrado: ni se formatea ni se marca el widget
+        curr_val = round(float(curr), 1) if curr is not None else None
+        if curr_val != last_current_temp:
+            last_current_temp = curr_val
+            if curr_val is not None:
+                txt_current_temp.value = fmt_celsius(round(curr_val * 10))
+                txt_current_temp.color = WHITE
             else:
                 txt_current_temp.value = "--.-°C"
-                txt_current_temp.color = ft.Colors.GREY
-
-            # 3. Estado Visual Caldera (Solo si Relé conectado)
-            if relay_connected:
-                if relay_on:
-                    card_status.bgcolor = ft.Colors.ORANGE_900
-                    card_status.content.value = "🔥 CALENTANDO"
-                    card_status.content.color = ft.Colors.ORANGE
-                    card_status.border = ft.border.all(2, ft.Colors.ORANGE)
-                else:
-                    card_status.bgcolor = ft.Colors.GREY_900
-                    card_status.content.value = "❄️ EN REPOSO"
-                    card_status.content.color = ft.Colors.GREY
-                    card_status.border = None
-
-            page.update()
+                txt_current_temp.color = GREY
+
+        # 3. Estado Visual Caldera (Solo si Relé conectado)
+        if relay_connected:
+            if relay_on:
+                card_status.bgcolor = ORANGE_900
+                card_status.content.value = "🔥 CALENTANDO"
+                card_status.content.color = ORANGE
+                card_status.border = BORDER_ORANGE
+            else:
+                card_status.bgcolor = GREY_900
+                card_status.content.value = "❄️ EN REPOSO"
+                card_status.content.color = GREY
+                card_status.border = None
+
+        schedule_update()
+
+    def on_unknown(data):
+        pass
+
+    handlers = {
+        "registered": on_registered,
+        "disconnected": on_disconnected,
+        "full_state_update": on_state,
+        "status_update": on_state,
+        "sensor_update": on_state,
+    }
+
+    def update_ui(data):
+        handlers.get(data.get("type"), on_unknown)(data)
 
     ws_client = WebSocketClient(update_ui)
 
@@ -295,6 +451,15 @@ def main(page: ft.Page):
     page.run_task(ws_client.connect_forever)
 
 if __name__ == "__main__":
+    # uvloop (si está disponible; no existe en Windows) para el bucle de Flet y del cliente WS.
+    # Flet crea su bucle con asyncio.run, así que basta con fijar la política antes.
+    if sys.platform != "win32":
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
+
     if PORT == 0:
         ft.app(target=main)
     else: